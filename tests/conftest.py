@@ -0,0 +1,266 @@
+import functools
+import hashlib
+import inspect
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+from workflow_registry import WORKFLOW_FACTORIES
+
+# the tritonclient import is guarded so that the suite is skipped at collection time when it's
+# missing (see pytest_collection_modifyitems), rather than failing while loading this file
+try:
+    import tritonclient
+    import tritonclient.grpc as grpcclient
+except ImportError:
+    grpcclient = None
+
+
+def _grpc_client_kwargs():
+    """the client connection is reused across every request in the session, so keep the channel
+    alive between tests on tritonclient releases that support configuring keepalive. Older
+    releases don't accept the keepalive_options argument, and are constructed with defaults"""
+    if "keepalive_options" not in inspect.signature(grpcclient.InferenceServerClient).parameters:
+        return {}
+    return {"keepalive_options": grpcclient.KeepAliveOptions(keepalive_time_ms=30000, keepalive_timeout_ms=5000)}
+
+
+# cached workflows that haven't been used for this long (in seconds) are evicted
+_WORKFLOW_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+
+@functools.lru_cache(maxsize=1)
+def _triton_path():
+    return shutil.which("tritonserver")
+
+
+def pytest_collection_modifyitems(config, items):
+    # skip the whole suite up front if tritonserver or its client isn't installed, rather than
+    # having every test fail trying to launch or connect to it
+    if grpcclient is None:
+        reason = "tritonclient not installed"
+    elif _triton_path() is None:
+        reason = "tritonserver not installed"
+    else:
+        return
+
+    skip = pytest.mark.skip(reason=reason)
+    for item in items:
+        item.add_marker(skip)
+
+
+def pytest_sessionfinish(session):
+    # evict cached workflows that haven't been used recently. Under pytest-xdist this only runs in
+    # the controller process, once all the workers are done with the cache
+    cache_dir = _workflow_cache_dir(session.config)
+    if cache_dir is None or hasattr(session.config, "workerinput"):
+        return
+
+    for entry in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, entry)
+        if time.time() - os.path.getmtime(path) > _WORKFLOW_CACHE_MAX_AGE:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def model_repository(tmp_path_factory):
+    return str(tmp_path_factory.mktemp("models"))
+
+
+@pytest.fixture(scope="session")
+def nvtabular_models(request, model_repository, pytestconfig, triton_process):
+    """returns a mapping of model name -> (df, locally transformed df). Only the models used by the
+    selected tests get built: tests name the model they use with a `model_name` parameter, and
+    those models are fit and exported here while tritonserver is starting up (this depends on
+    triton_process, but not on the server being ready). Any other registered workflow is built the
+    first time it's looked up"""
+    models = _ExportedModels(model_repository, _workflow_cache_dir(pytestconfig))
+
+    # pytest-xdist workers collect every test but only run the ones they're scheduled, so there
+    # we can't tell which models will be used and leave them all to be built on first use
+    if "PYTEST_XDIST_WORKER" not in os.environ:
+        for item in request.session.items:
+            callspec = getattr(item, "callspec", None)
+            if callspec is not None and "model_name" in callspec.params:
+                # looking the model up fits and exports it
+                models[callspec.params["model_name"]]
+
+    return models
+
+
+class _ExportedModels(dict):
+    """dict of model name -> (df, locally transformed df) that builds missing entries on lookup"""
+
+    def __init__(self, model_repository, cache_dir):
+        super().__init__()
+        self.model_repository = model_repository
+        self.cache_dir = cache_dir
+
+    def __missing__(self, model_name):
+        # nvtabular (and cudf) are imported here rather than at module level, since initializing
+        # them takes several seconds that would otherwise be paid even when just collecting tests
+        import nvtabular.inference.triton as nvt_triton
+
+        factory = WORKFLOW_FACTORIES[model_name]
+        workflow, df = factory()
+        workflow = _fit_workflow(workflow, df, factory, self.cache_dir)
+        model_path = self.model_repository + f"/{model_name}"
+        nvt_triton.generate_nvtabular_model(workflow, model_name, model_path, backend="nvtabular")
+
+        # transform the frame directly rather than going through a dask graph, which is pure
+        # overhead for these tiny inputs
+        self[model_name] = (df, workflow._transform_df(df))
+        return self[model_name]
+
+
+def _workflow_cache_dir(config):
+    """returns the directory fitted workflows are cached in between sessions, or None if the
+    cacheprovider plugin is disabled. pytest 7 renamed Cache.makedir to Cache.mkdir"""
+    cache = getattr(config, "cache", None)
+    if cache is None:
+        return None
+    mkdir = cache.mkdir if hasattr(cache, "mkdir") else cache.makedir
+    return str(mkdir("nvtabular_workflows"))
+
+
+def _fit_workflow(workflow, df, factory, cache_dir):
+    """fits the workflow on df, reusing the fitted workflow from a previous session if the same
+    workflow has already been fit on the same data. Returns the fitted workflow"""
+    import cloudpickle
+    import cudf
+    import pandas as pd
+
+    import nvtabular as nvt
+
+    if cache_dir is None:
+        workflow.fit(nvt.Dataset(df))
+        return workflow
+
+    # key the cache on the (unfit) workflow definition, the source of the module defining the
+    # factory, the contents of the input frame and the library versions. cloudpickle pickles
+    # functions from importable modules by reference, so the module source is what picks up edits
+    # to module level transforms, and the versions make upgrading nvtabular or cudf refit rather
+    # than load stats saved by the old version
+    func = factory.func if isinstance(factory, functools.partial) else factory
+    pdf = df.to_pandas()
+    hasher = hashlib.sha256(cloudpickle.dumps(workflow))
+    hasher.update(inspect.getsource(inspect.getmodule(func)).encode())
+    hasher.update(f"nvtabular={nvt.__version__},cudf={cudf.__version__}".encode())
+    hasher.update(str(list(pdf.dtypes.items())).encode())
+    hasher.update(pd.util.hash_pandas_object(pdf).values.tobytes())
+    path = os.path.join(cache_dir, hasher.hexdigest())
+
+    if not os.path.exists(path):
+        workflow.fit(nvt.Dataset(df))
+
+        # save to a temporary location first, so that concurrent pytest-xdist workers never load
+        # a partially written workflow
+        tmp_path = f"{path}.{os.getpid()}"
+        workflow.save(tmp_path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another worker already cached this workflow
+            shutil.rmtree(tmp_path)
+    else:
+        # mark the entry as recently used, so that pytest_sessionfinish doesn't evict it
+        os.utime(path)
+
+    # always load from the cache, since saving points the workflow's stats at the save location
+    return nvt.Workflow.load(path)
+
+
+@pytest.fixture(scope="session")
+def triton_process(model_repository, tmp_path_factory):
+    """launches a single tritonserver for the whole test session, without waiting for it to become
+    ready. Models are loaded and unloaded explicitly by each test rather than restarting the server
+    per test. Yields the server process and the grpc url to connect to"""
+    # give each pytest-xdist worker its own grpc port, and disable the http and metrics endpoints
+    # (which we don't use) so that several servers can run side by side
+    grpc_port = 8001 + int(os.environ.get("PYTEST_XDIST_WORKER", "gw0")[2:])
+    cmdline = [
+        _triton_path(),
+        "--model-repository",
+        model_repository,
+        "--model-control-mode=explicit",
+        f"--grpc-port={grpc_port}",
+        "--allow-http=false",
+        "--allow-metrics=false",
+    ]
+
+    grpc_url = f"localhost:{grpc_port}"
+    if sys.platform.startswith("linux"):
+        # talk to tritonserver over a unix domain socket rather than going through the loopback
+        # TCP stack. Note that tritonserver appends the grpc port to the address it binds to
+        socket_path = tmp_path_factory.mktemp("triton") / "triton.sock"
+        cmdline.append(f"--grpc-address=unix://{socket_path}")
+        grpc_url = f"unix://{socket_path}:{grpc_port}"
+
+    # pin the server to a single gpu unless the environment already picked one
+    env = dict(os.environ)
+    env.setdefault("CUDA_VISIBLE_DEVICES", "0")
+
+    with subprocess.Popen(cmdline, env=env) as process:
+        try:
+            yield process, grpc_url
+        finally:
+            # signal triton to shutdown
+            process.send_signal(signal.SIGINT)
+
+
+@pytest.fixture(scope="session")
+def triton_server(triton_process, nvtabular_models):
+    """returns a grpc client for the session tritonserver once it is ready. This depends on
+    nvtabular_models so that the workflows are fit and exported while the server is starting up"""
+    process, grpc_url = triton_process
+
+    # wait for the grpc endpoint to accept connections before creating the client, probing with a
+    # plain socket rather than making grpc calls that fail with an exception until then
+    _wait_until(process, lambda: _can_connect(grpc_url), "tritonserver to accept connections")
+
+    with grpcclient.InferenceServerClient(grpc_url, **_grpc_client_kwargs()) as client:
+
+        def is_server_ready():
+            try:
+                return client.is_server_ready()
+            except tritonclient.utils.InferenceServerException:
+                return False
+
+        _wait_until(process, is_server_ready, "tritonserver to become ready")
+        yield client
+
+
+def _can_connect(grpc_url):
+    if grpc_url.startswith("unix://"):
+        family, address = socket.AF_UNIX, grpc_url[len("unix://") :]
+    else:
+        host, port = grpc_url.rsplit(":", 1)
+        family, address = socket.AF_INET, (host, int(port))
+
+    with socket.socket(family) as sock:
+        return sock.connect_ex(address) == 0
+
+
+def _wait_until(process, condition, description, timeout=60):
+    """polls condition until it returns True, raising if the tritonserver process exits or if the
+    timeout expires first. This backs off exponentially so that we don't oversleep when the server
+    comes up quickly"""
+    delay = 0.05
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            retcode = process.returncode
+            raise RuntimeError(f"Tritonserver failed to start (ret={retcode})")
+
+        if condition():
+            return
+
+        time.sleep(delay)
+        delay = min(delay * 1.5, 0.5)
+
+    raise RuntimeError(f"Timed out waiting for {description}")
@@ -1,73 +1,122 @@
 import contextlib
-import signal
-import subprocess
-import time
-from distutils.spawn import find_executable
+import functools
+import os
 
-import cudf
 import numpy as np
 import pytest
-import tritonclient
-import tritonclient.grpc as grpcclient
-from cudf.tests.utils import assert_eq
+from workflow_registry import register_workflow
 
-import nvtabular as nvt
-import nvtabular.inference.triton as nvt_triton
-import nvtabular.ops as ops
+# NOTE: cudf, nvtabular and tritonclient are imported lazily inside the functions that need them,
+# so that collecting these tests doesn't pay for initializing cudf and the CUDA driver, and so that
+# the suite is skipped rather than failing to import when they aren't installed
 
-_TRITON_SERVER_PATH = find_executable("tritonserver")
+# every numeric dtype we expect to round-trip through tritonserver
+_NUMERIC_DTYPES = [f"{kind}{width}" for width in [8, 16, 32, 64] for kind in ["int", "uint"]]
+_NUMERIC_DTYPES += ["float32", "float64"]
 
 
-@contextlib.contextmanager
-def run_triton_server(modelpath):
-    cmdline = [_TRITON_SERVER_PATH, "--model-repository", modelpath]
-    with subprocess.Popen(cmdline) as process:
-        try:
-            with grpcclient.InferenceServerClient("localhost:8001") as client:
-                # wait until server is ready
-                for _ in range(60):
-                    if process.poll() is not None:
-                        retcode = process.returncode
-                        raise RuntimeError(f"Tritonserver failed to start (ret={retcode})")
+def _round_trip_values(dtype_name):
+    """returns an array of the max, zero and min values of the dtype"""
+    limits = np.finfo(dtype_name) if dtype_name.startswith("float") else np.iinfo(dtype_name)
+    values = np.empty(3, dtype=dtype_name)
+    values[0], values[1], values[2] = limits.max, 0, limits.min
+    return values
+
 
-                    try:
-                        ready = client.is_server_ready()
-                    except tritonclient.utils.InferenceServerException:
-                        ready = False
+_NUMERIC_DTYPE_VALUES = {dtype_name: _round_trip_values(dtype_name) for dtype_name in _NUMERIC_DTYPES}
 
-                    if ready:
-                        yield client
-                        return
 
-                    time.sleep(1)
+@contextlib.contextmanager
+def load_model(client, model_name):
+    client.load_model(model_name)
+    try:
+        # load_model is synchronous, but check that the model is actually ready to serve here
+        # rather than finding out inside the first infer call
+        if not client.is_model_ready(model_name):
+            raise RuntimeError(f"Model '{model_name}' isn't ready after loading")
+        yield
+    finally:
+        client.unload_model(model_name)
+
 
-                raise RuntimeError("Timed out waiting for tritonserver to become ready")
+@contextlib.contextmanager
+def shared_memory_inputs(client, columns, df):
+    """stages each column in a system shared memory region registered with tritonserver, yielding
+    triton inputs that reference those regions rather than carrying the data in the request"""
+    import tritonclient.grpc as grpcclient
+    import tritonclient.utils.shared_memory as shm
+    from tritonclient.utils import np_to_triton_dtype
+
+    # regions are tracked separately as they're created and registered, so that a failure part way
+    # through only unregisters what was registered, and still destroys everything that was created
+    inputs, handles, registered = [], [], []
+    try:
+        for col in columns:
+            values = df[col].to_pandas().to_numpy()
+            if values.dtype.kind == "O":
+                for value in values:
+                    if not isinstance(value, str):
+                        raise TypeError(f"Can't pass {value!r} in column '{col}' as a BYTES input")
+
+                # BYTES tensors are serialized as a 4 byte length followed by the value
+                values = np.array([value.encode() for value in values], dtype=np.object_)
+                byte_size = sum(4 + len(value) for value in values)
+            else:
+                byte_size = values.nbytes
+            values = values.reshape(len(values), 1)
+
+            region_name = f"{col}_{os.getpid()}"
+            handle = shm.create_shared_memory_region(region_name, f"/{region_name}", byte_size)
+            handles.append(handle)
+            shm.set_shared_memory_region(handle, [values])
+            client.register_system_shared_memory(region_name, f"/{region_name}", byte_size)
+            registered.append(region_name)
+
+            infer_input = grpcclient.InferInput(col, values.shape, np_to_triton_dtype(values.dtype))
+            infer_input.set_shared_memory(region_name, byte_size)
+            inputs.append(infer_input)
+
+        yield inputs
+    finally:
+        try:
+            for region_name in registered:
+                client.unregister_system_shared_memory(region_name)
         finally:
-            # signal triton to shutdown
-            process.send_signal(signal.SIGINT)
+            for handle in handles:
+                shm.destroy_shared_memory_region(handle)
 
 
-def _verify_workflow_on_tritonserver(tmpdir, workflow, df, model_name):
+def _verify_workflow_on_tritonserver(client, nvtabular_models, model_name, use_shared_memory=False):
     """tests that the nvtabular workflow produces the same results when run locally in the
     process, and when run in tritonserver"""
-    # fit the workflow and test on the input
-    dataset = nvt.Dataset(df)
-    workflow.fit(dataset)
+    import nvtabular.inference.triton as nvt_triton
+
+    df, local_df = nvtabular_models[model_name]
 
-    local_df = workflow.transform(dataset).to_ddf().compute(scheduler="synchronous")
-    nvt_triton.generate_nvtabular_model(workflow, model_name, tmpdir + f"/{model_name}", backend="nvtabular")
+    with contextlib.ExitStack() as stack:
+        if use_shared_memory:
+            inputs = stack.enter_context(shared_memory_inputs(client, df.columns, df))
+        else:
+            inputs = nvt_triton.convert_df_to_triton_input(df.columns, df)
 
-    inputs = nvt_triton.convert_df_to_triton_input(df.columns, df)
-    with run_triton_server(tmpdir) as client:
+        stack.enter_context(load_model(client, model_name))
         response = client.infer(model_name, inputs)
 
         for col in df.columns:
+            # as_numpy wraps the grpc output buffer with np.frombuffer, so both this and the ravel
+            # are views of the response rather than copies
             features = response.as_numpy(col)
-            triton_df = cudf.DataFrame({col: features.reshape(features.shape[0])})
-            assert_eq(triton_df, local_df[[col]])
+            expected = local_df[col].to_pandas().to_numpy()
+            assert features.dtype == expected.dtype
+            np.testing.assert_array_equal(features.ravel(), expected)
+
 
+@register_workflow("test_error_handling")
+def _error_handling_workflow():
+    import cudf
+    import nvtabular as nvt
+    import nvtabular.ops as ops
 
-def test_error_handling(tmpdir):
     df = cudf.DataFrame({"x": np.arange(10), "y": np.arange(10)})
 
     def custom_transform(col):
@@ -76,48 +125,59 @@ def test_error_handling(tmpdir):
         return col
 
     features = ["x", "y"] >> ops.FillMissing() >> ops.Normalize() >> custom_transform
-    workflow = nvt.Workflow(features)
-    workflow.fit(nvt.Dataset(df))
+    return nvt.Workflow(features), df
+
+
+@pytest.mark.parametrize("model_name", ["test_error_handling"])
+def test_error_handling(triton_server, nvtabular_models, model_name):
+    import nvtabular.inference.triton as nvt_triton
+    import tritonclient.utils
 
-    model_name = "test_error_handling"
-    nvt_triton.generate_nvtabular_model(workflow, model_name, tmpdir + f"/{model_name}", backend="nvtabular")
+    df, _ = nvtabular_models[model_name]
 
-    with run_triton_server(tmpdir) as client:
+    with load_model(triton_server, model_name):
         inputs = nvt_triton.convert_df_to_triton_input(["x", "y"], df[:2])
         # previously had a bug where an exception would segfault the tritonserver process
         #  - but since this happened AFTER the response was sent, just testing this once
         # isn't sufficient, so lets verify that we can get an error back several times
         for _ in range(3):
             with pytest.raises(tritonclient.utils.InferenceServerException) as exception_info:
-                client.infer(model_name, inputs)
+                triton_server.infer(model_name, inputs)
             assert "ValueError: Lets cause some problems" in str(exception_info.value)
 
-def test_tritonserver_inference_string(tmpdir):
-    df = cudf.DataFrame({"user": ["aaaa", "bbbb", "cccc", "aaaa", "bbbb", "aaaa"]})
-    features = ["user"] >> ops.Categorify()
-    workflow = nvt.Workflow(features)
-    _verify_workflow_on_tritonserver(tmpdir, workflow, df, "test_inference_string")
 
+# column name and values for each string input that should round-trip through Categorify
+_STRING_INPUTS = {
+    "test_inference_string": ("user", ["aaaa", "bbbb", "cccc", "aaaa", "bbbb", "aaaa"]),
+    "test_large_string": ("description", ["a" * (2 ** exp) for exp in range(1, 17)]),
+}
 
-def test_large_strings(tmpdir):
-    strings = ["a" * (2 ** exp) for exp in range(1, 17)]
-    df = cudf.DataFrame({"description": strings})
-    features = ["description"] >> ops.Categorify()
-    workflow = nvt.Workflow(features)
-    _verify_workflow_on_tritonserver(tmpdir, workflow, df, "test_large_string")
 
+def _string_workflow(model_name):
+    import cudf
+    import nvtabular as nvt
+    import nvtabular.ops as ops
 
-def test_numeric_dtypes(tmpdir):
-    dtypes = []
-    for width in [8, 16, 32, 64]:
-        dtype = f"int{width}"
-        dtypes.append((dtype, np.iinfo(dtype)))
-        dtype = f"uint{width}"
-        dtypes.append((dtype, np.iinfo(dtype)))
+    col, values = _STRING_INPUTS[model_name]
+    df = cudf.DataFrame({col: values})
+    features = [col] >> ops.Categorify()
+    return nvt.Workflow(features), df
 
-    for width in [32, 64]:
-        dtype = f"float{width}"
-        dtypes.append((dtype, np.finfo(dtype)))
+
+for _model_name in _STRING_INPUTS:
+    register_workflow(_model_name)(functools.partial(_string_workflow, _model_name))
+
+
+# check passing the strings both inside the grpc request, and through shared memory
+@pytest.mark.parametrize("use_shared_memory", [False, True])
+@pytest.mark.parametrize("model_name", list(_STRING_INPUTS))
+def test_tritonserver_inference_string(triton_server, nvtabular_models, model_name, use_shared_memory):
+    _verify_workflow_on_tritonserver(triton_server, nvtabular_models, model_name, use_shared_memory)
+
+
+def _numeric_dtype_workflow(dtype_name):
+    import cudf
+    import nvtabular as nvt
 
     def check_dtypes(col):
         assert str(col.dtype) == col.name
@@ -125,7 +185,21 @@ def test_numeric_dtypes(tmpdir):
 
     # simple transform to make sure we can round-trip the min/max values for each dtype,
     # through triton, with the 'transform' here just checking that the dtypes are correct
-    df = cudf.DataFrame({dtype: np.array([limits.max, 0, limits.min], dtype=dtype) for dtype, limits in dtypes})
+    df = cudf.DataFrame({dtype_name: _NUMERIC_DTYPE_VALUES[dtype_name]})
     features = nvt.ColumnGroup(df.columns) >> check_dtypes
-    workflow = nvt.Workflow(features)
-    _verify_workflow_on_tritonserver(tmpdir, workflow, df, "test_numeric_dtypes")
+    return nvt.Workflow(features), df
+
+
+def _numeric_dtype_model_name(dtype_name):
+    return f"test_numeric_dtype_{dtype_name}"
+
+
+for _dtype_name in _NUMERIC_DTYPES:
+    register_workflow(_numeric_dtype_model_name(_dtype_name))(functools.partial(_numeric_dtype_workflow, _dtype_name))
+
+
+@pytest.mark.parametrize(
+    "model_name", [_numeric_dtype_model_name(dtype_name) for dtype_name in _NUMERIC_DTYPES], ids=_NUMERIC_DTYPES
+)
+def test_numeric_dtype(triton_server, nvtabular_models, model_name):
+    _verify_workflow_on_tritonserver(triton_server, nvtabular_models, model_name)
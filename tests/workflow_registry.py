@@ -0,0 +1,21 @@
+# model name -> function returning an unfit (workflow, df) pair. Registered workflows are fit and
+# exported to the session model repository by the `nvtabular_models` fixture in conftest.py
+WORKFLOW_FACTORIES = {}
+
+
+def register_workflow(model_name):
+    """decorator that registers a function returning a (workflow, df) pair, to be fit on df and
+    exported to the session model repository as model_name.
+
+    Fitted workflows are cached between sessions, keyed on the pickled workflow, the input data and
+    the source of the module defining the factory. Any transforms or ops that affect the fitted
+    stats must therefore be defined in the same module as the factory: edits to code imported from
+    elsewhere won't invalidate the cache"""
+
+    def decorator(factory):
+        if model_name in WORKFLOW_FACTORIES:
+            raise ValueError(f"workflow '{model_name}' is already registered")
+        WORKFLOW_FACTORIES[model_name] = factory
+        return factory
+
+    return decorator